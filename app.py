@@ -3,8 +3,11 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import calendar
+import io
 from pvlib import pvsystem, modelchain, location, iotools
 
+from battery import battery_and_grid
+
 # ------------------------------
 # 🧰 Sidebar: User Input
 # ------------------------------
@@ -41,111 +44,149 @@ array_kwargs = dict(
     temperature_model_parameters=dict(a=-3.56, b=-0.075, deltaT=3)
 )
 
-arrays = [
-    pvsystem.Array(mount=pvsystem.FixedMount(90, az), name=f"Array {az:.1f}°", **array_kwargs)
-    for az in orientations
-]
-
-system = pvsystem.PVSystem(
-    arrays=arrays,
-    inverter_parameters=dict(pdc0=total_dc_power_kw)
-)
-mc = modelchain.ModelChain(system, loc, aoi_model='physical', spectral_model='no_loss')
+# Everything the pvlib system is built from, passed to the cached builders as
+# one hashable key
+system_spec = (tuple(orientations), total_dc_power_kw, array_kwargs)
 
 # ------------------------------
 # 🔄 Time Series Setup
 # ------------------------------
 reference_date = '2019-01-01'
-time_range = pd.date_range(f'{reference_date} 05:00', f'{reference_date} 20:00', freq='0.5h', tz='Etc/GMT+5')
-times_local = time_range.tz_convert(loc.tz)
-time_of_day = times_local.strftime('%H:%M')
-time_of_day_shifted = (times_local + pd.Timedelta(hours=0)).strftime('%H:%M')
+time_step = '0.5h'
+dt_h = pd.Timedelta(time_step).total_seconds() / 3600  # hours per step
+time_shift = pd.Timedelta(hours=0)  # display shift; zero means none
+
+@st.cache_data
+def build_time_axis(date, freq, tz, shift=pd.Timedelta(0)):
+    time_range = pd.date_range(f'{date} 05:00', f'{date} 20:00', freq=freq, tz='Etc/GMT+5')
+    times_local = time_range.tz_convert(tz)
+    time_of_day = times_local.strftime('%H:%M')
+    time_of_day_shifted = (times_local + shift).strftime('%H:%M')
+    return time_range, time_of_day, time_of_day_shifted
+
+_, _, time_of_day_shifted = build_time_axis(reference_date, time_step, loc.tz, time_shift)
 
 # ------------------------------
 # 📊 Simulation
 # ------------------------------
-results_raw = pd.DataFrame(index=time_of_day)
-monthly_energy_kwh = {}
+@st.cache_data(ttl=24 * 60 * 60)
+def fetch_tmy(lat, lon):
+    weather, *_ = iotools.get_pvgis_tmy(lat, lon, map_variables=True)
+    return weather
+
+@st.cache_resource(max_entries=4)
+def build_system(azimuths, pdc0, array_params):
+    # Keyed on the geometry only, so one PVSystem serves every location
+    arrays = [
+        pvsystem.Array(mount=pvsystem.FixedMount(90, az), name=f"Array {az:.1f}°", **array_params)
+        for az in azimuths
+    ]
+    return pvsystem.PVSystem(
+        arrays=arrays,
+        inverter_parameters=dict(pdc0=pdc0)
+    )
+
+@st.cache_resource(max_entries=16)
+def build_mc(lat, lon, spec):
+    # Keyed on the raw coordinates, so keep only the most recent locations
+    loc = location.Location(latitude=lat, longitude=lon)
+    return modelchain.ModelChain(build_system(*spec), loc, aoi_model='physical', spectral_model='no_loss')
+
+@st.cache_data(ttl=24 * 60 * 60, show_spinner=False)
+def simulate(lat, lon, date, freq, spec):
+    # The cache key only covers the arguments and this source, so the system
+    # and time axis come from arguments here rather than from module globals
+    mc = build_mc(lat, lon, spec)
+    loc = mc.location
+    time_range, time_of_day, _ = build_time_axis(date, freq, loc.tz)
+    step_h = pd.Timedelta(freq).total_seconds() / 3600
 
-for month in range(1, 13):
-    times = time_range.map(lambda t: t.replace(month=month))
     try:
-        weather, _, _, _ = iotools.get_pvgis_tmy(latitude, longitude, map_variables=True)
-        weather = weather.loc[times]
-    except:
-        weather = loc.get_clearsky(times)
-
-    mc.run_model(weather)
-    total_dc_output = sum(mc.results.dc)
-    month_name = calendar.month_name[month]
-    results_raw[month_name] = total_dc_output.values
-    energy_kwh = total_dc_output.sum() * 0.5  # 0.5 hour steps
-    monthly_energy_kwh[month_name] = energy_kwh
-
-# ------------------------------
-# 🔋 Battery Simulation
-# ------------------------------
-results_battery = results_raw.copy()
-if battery_enabled:
-    for month in results_raw.columns:
-        soc = 0.0
-        adjusted = []
-        for power in results_raw[month]:
-            energy = power * 0.5
-            excess = max(0, energy - 0.5)
-            charge = min(excess * 0.95, battery_capacity_kwh - soc)
-            soc += charge
-            net = energy - charge
-            if net < 0.5:
-                needed = 0.5 - net
-                discharge = min(needed / 0.95, soc)
-                soc -= discharge
-                net += discharge * 0.95
-            adjusted.append(net / 0.5)
-        results_battery[month] = adjusted
-else:
-    results_battery = None
+        # ~100 m is far finer than the PVGIS grid, so nearby inputs share a download
+        weather_tmy = fetch_tmy(round(lat, 3), round(lon, 3))
+    except Exception:
+        weather_tmy = None
+
+    # One representative day per month, simulated together in a single model run
+    month_times = [time_range + pd.DateOffset(months=month - 1) for month in range(1, 13)]
+    times = month_times[0].append(month_times[1:])
+
+    # Months the TMY covers use it, the rest fall back to clear-sky
+    tmy_months = np.zeros(12, dtype=bool)
+    if weather_tmy is not None:
+        tmy_months = times.isin(weather_tmy.index).reshape(12, -1).all(axis=1)
+    use_tmy = np.repeat(tmy_months, len(time_range))
+
+    # The two groups run separately so clear-sky rows keep ModelChain's own
+    # temperature, wind and pressure defaults
+    total_dc_output = np.empty(len(times))
+    for rows, real_weather in ((use_tmy, True), (~use_tmy, False)):
+        if not rows.any():
+            continue
+        weather = weather_tmy.loc[times[rows]] if real_weather else loc.get_clearsky(times[rows])
+        mc.run_model(weather)
+        dc_matrix = np.stack([dc.to_numpy(dtype=np.float64, copy=False) for dc in mc.results.dc])
+        total_dc_output[rows] = dc_matrix.sum(axis=0)
+    dc_by_month = total_dc_output.reshape(12, len(time_range))
+    results_raw = pd.DataFrame(
+        dc_by_month.T,
+        index=time_of_day,
+        columns=list(calendar.month_name)[1:],
+        dtype=np.float64
+    )
+    monthly_energy_kwh = dc_by_month.sum(axis=1) * step_h  # one total per month
+    return results_raw, monthly_energy_kwh
+
+results_raw, monthly_energy_kwh = simulate(latitude, longitude, reference_date, time_step, system_spec)
+month_names = list(results_raw.columns)
 
 # ------------------------------
-# 🚜 Smart Grid
+# 🔋 Battery + 🚜 Smart Grid
 # ------------------------------
-results_smart_grid = results_battery.copy() if results_battery is not None else results_raw.copy()
-if grid_enabled:
-    for month in results_smart_grid.columns:
-        adjusted = []
-        for power_kw in results_smart_grid[month]:
-            if power_kw < 1.0:
-                support = min(grid_limit_kw, 1.0 - power_kw)
-                adjusted.append(power_kw + support)
-            else:
-                adjusted.append(power_kw)
-        results_smart_grid[month] = adjusted
-else:
-    results_smart_grid = None
+results_battery = None
+results_smart_grid = None
+if battery_enabled or grid_enabled:
+    # 0.95 charge and discharge efficiency, 0.5 kWh demand per step, 1 kW grid target
+    battery_out, grid_out = battery_and_grid(results_raw.to_numpy(dtype=np.float64), dt_h,
+                                             battery_capacity_kwh, 0.95, 0.95, 0.5,
+                                             grid_limit_kw, 1.0,
+                                             battery_enabled, grid_enabled)
+    if battery_enabled:
+        results_battery = pd.DataFrame(battery_out, index=results_raw.index, columns=month_names)
+    if grid_enabled:
+        results_smart_grid = pd.DataFrame(grid_out, index=results_raw.index, columns=month_names)
 
 # ------------------------------
 # 📊 Plotting
 # ------------------------------
-def plot_profiles(df, title):
-    st.subheader(title)
+@st.cache_data(max_entries=16, show_spinner=False)
+def render_profiles_png(df, time_labels):
+    # Same savefig settings st.pyplot uses; each PNG is a few hundred kB,
+    # so only the most recent figures are kept
     fig, ax = plt.subplots(figsize=(10, 6))
-    for i, month in enumerate(df.columns):
-        ax.plot(time_of_day_shifted, df[month], label=month)
+    ax.plot(time_labels, df.to_numpy(), label=list(df.columns))
     ax.set_xlabel("Time of Day")
     ax.set_ylabel("Power Output (kW)")
     ax.legend()
     ax.grid(True)
-    st.pyplot(fig)
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", dpi=200, bbox_inches="tight")
+    plt.close(fig)
+    return buf.getvalue()
+
+def plot_profiles(df, title):
+    st.subheader(title)
+    st.image(render_profiles_png(df, tuple(time_of_day_shifted)), width="stretch")
 
-def plot_energy_summary(energy_dict):
+def plot_energy_summary(monthly_energy):
     st.subheader("Monthly Energy Production")
     fig, ax = plt.subplots(figsize=(10, 5))
-    ax.bar(energy_dict.keys(), energy_dict.values(), color='skyblue')
+    ax.bar(month_names, monthly_energy, color='skyblue')
     ax.set_ylabel("Energy (kWh)")
     ax.set_title("Monthly Energy Output")
     ax.tick_params(axis='x', rotation=45)
     st.pyplot(fig)
-    total = sum(energy_dict.values())
+    total = monthly_energy.sum()
     st.success(f"Total Annual Energy: {total:.2f} kWh")
 
 # Show plots
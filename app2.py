@@ -1,15 +1,20 @@
 import numpy as np
 import matplotlib.pyplot as plt
-from pvlib import pvsystem, modelchain, location, iotools
+from cycler import cycler
+from joblib import Memory
+from pvlib import pvsystem, location, iotools, irradiance, iam, temperature, atmosphere
 import pandas as pd
 import calendar
 
+from battery import battery_and_grid
+
 # === GLOBAL SETTINGS ===
 # Location & simulation
 CUSTOM_LATITUDE = 40
 CUSTOM_LONGITUDE = -80
 USE_CUSTOM_LOCATION = True
 USE_REAL_WEATHER = True
+PVGIS_CACHE_DIR = '.pvgis_cache'  # TMY downloads are reused from here across runs
 
 # Battery simulation
 SIMULATE_BATTERY = True
@@ -23,14 +28,12 @@ GRID_SUPPORT_LIMIT_KW = 2.0
 
 # Tower and panel specs
 TOWER_DIAMETER = 0.6  # meters
-TOWER_HEIGHT = 12  # meters
 PANEL_WIDTH = 0.1  # meters
-PANEL_HEIGHT = 1.0  # meters
-POWER_DENSITY = 175  # W/m^2
 
 # Simulation time step and time shift for display
 TIME_STEP = '1h'  # Use lowercase 'h' as requested
 TIME_SHIFT = 0  # hours; 0 means no shift for display
+DT_H = pd.Timedelta(TIME_STEP).total_seconds() / 3600  # time step in hours
 
 # === PREPARE LOCATION AND TIME RANGE ===
 if USE_CUSTOM_LOCATION:
@@ -46,118 +49,118 @@ times_local = time_range.tz_convert(loc.tz)
 # Format time of day for display (with optional time shift)
 time_of_day = (times_local + pd.Timedelta(hours=TIME_SHIFT)).strftime('%H:%M')
 
+# Month labels, used as the results columns
+MONTH_NAMES = list(calendar.month_name)[1:]
+
 # === PANEL ARRAY CALCULATIONS ===
 num_panels_circumference = int(np.ceil((np.pi * TOWER_DIAMETER) / PANEL_WIDTH))
-num_panels_height = int(TOWER_HEIGHT / PANEL_HEIGHT)
-panel_area_total = num_panels_circumference * num_panels_height * PANEL_WIDTH * PANEL_HEIGHT
-total_dc_power_kw = (panel_area_total * POWER_DENSITY) / 1000
 
 panel_orientations = np.linspace(0, 360, num_panels_circumference, endpoint=False)
 
-array_kwargs = dict(
-    module_parameters=dict(pdc0=1, gamma_pdc=-0.004),
-    temperature_model_parameters=dict(a=-3.56, b=-0.075, deltaT=3)
+# Every panel column shares these parameters; only the azimuth differs
+module_parameters = dict(pdc0=1, gamma_pdc=-0.004)
+temperature_model_parameters = dict(a=-3.56, b=-0.075, deltaT=3)
+
+# === WEATHER DATA ===
+# Fetch the annual TMY once; the simulated days are sliced from it below
+get_pvgis_tmy = Memory(PVGIS_CACHE_DIR, verbose=0).cache(iotools.get_pvgis_tmy)
+
+weather_tmy = None
+if USE_REAL_WEATHER:
+    try:
+        weather_tmy, *_ = get_pvgis_tmy(loc.latitude, loc.longitude, map_variables=True)
+    except Exception:
+        pass
+
+# === MAIN SIMULATION ===
+# One representative day per month, simulated together in a single pass
+month_times = [time_range + pd.DateOffset(months=month - 1) for month in range(1, 13)]
+times = month_times[0].append(month_times[1:])
+
+# Months the TMY covers use it, the rest fall back to clear-sky
+tmy_months = np.zeros(12, dtype=bool)
+if weather_tmy is not None:
+    tmy_months = times.isin(weather_tmy.index).reshape(12, -1).all(axis=1)
+use_tmy = np.repeat(tmy_months, len(time_range))
+tmy_rows = weather_tmy.loc[times[use_tmy]] if use_tmy.any() else None
+
+# Clear-sky rows keep pvlib's default pressure and temperature for the solar position
+pressure = np.full(len(times), atmosphere.alt2pres(loc.altitude))
+spa_temperature = np.full(len(times), 12.0)
+if tmy_rows is not None:
+    pressure[use_tmy] = tmy_rows['pressure']
+    spa_temperature[use_tmy] = tmy_rows['temp_air']
+solar_position = loc.get_solarposition(times, pressure=pressure, temperature=spa_temperature)
+
+weather = loc.get_clearsky(times, solar_position=solar_position)
+weather['temp_air'] = 20.0
+weather['wind_speed'] = 0.0
+if tmy_rows is not None:
+    weather_columns = ['ghi', 'dni', 'dhi', 'temp_air', 'wind_speed']
+    weather.loc[use_tmy, weather_columns] = tmy_rows[weather_columns].to_numpy()
+
+# Columns are broadcast as (time, 1) against the (1, panel) azimuths, so each
+# model below evaluates all vertical panel orientations in one array operation
+surface_azimuth = panel_orientations[np.newaxis, :]
+solar_zenith = solar_position['apparent_zenith'].to_numpy()[:, np.newaxis]
+solar_azimuth = solar_position['azimuth'].to_numpy()[:, np.newaxis]
+airmass = loc.get_airmass(solar_position=solar_position)['airmass_relative']
+dni_extra = irradiance.get_extra_radiation(times)
+
+poa = irradiance.get_total_irradiance(
+    90, surface_azimuth, solar_zenith, solar_azimuth,
+    weather['dni'].to_numpy()[:, np.newaxis],
+    weather['ghi'].to_numpy()[:, np.newaxis],
+    weather['dhi'].to_numpy()[:, np.newaxis],
+    dni_extra=dni_extra.to_numpy()[:, np.newaxis],
+    airmass=airmass.to_numpy()[:, np.newaxis],
+    model='haydavies'
 )
-
-arrays = [
-    pvsystem.Array(
-        mount=pvsystem.FixedMount(90, az),
-        name=f'Array {az:.1f}°',
-        **array_kwargs
-    )
-    for az in panel_orientations
-]
-
-system = pvsystem.PVSystem(
-    arrays=arrays,
-    inverter_parameters=dict(pdc0=total_dc_power_kw)
+aoi = irradiance.aoi(90, surface_azimuth, solar_zenith, solar_azimuth)
+effective_irradiance = poa['poa_direct'] * iam.physical(aoi) + poa['poa_diffuse']
+temp_cell = temperature.sapm_cell(poa['poa_global'],
+                                  weather['temp_air'].to_numpy()[:, np.newaxis],
+                                  weather['wind_speed'].to_numpy()[:, np.newaxis],
+                                  **temperature_model_parameters)
+dc_matrix = pvsystem.pvwatts_dc(effective_irradiance, temp_cell, **module_parameters)
+total_dc_output = dc_matrix.sum(axis=1)
+dc_by_month = total_dc_output.reshape(12, len(time_range))
+
+# Rows are time of day, columns are months
+results_raw = pd.DataFrame(
+    dc_by_month.T,
+    index=time_of_day,
+    columns=MONTH_NAMES,
+    dtype=np.float64
 )
 
-mc = modelchain.ModelChain(system, loc, aoi_model='physical', spectral_model='no_loss')
-
-# === SIMULATION STORAGE ===
-results_raw = pd.DataFrame(index=time_of_day)
-monthly_energy_kwh = {}
-
-# === MAIN SIMULATION LOOP ===
-for month in range(1, 13):
-    # Create time index with the current month
-    times = time_range.map(lambda t: t.replace(month=month))
-
-    if USE_REAL_WEATHER:
-        try:
-            weather, _, _, _ = iotools.get_pvgis_tmy(loc.latitude, loc.longitude, map_variables=True)
-            weather = weather.loc[times]
-        except Exception:
-            weather = loc.get_clearsky(times)
-    else:
-        weather = loc.get_clearsky(times)
-
-    mc.run_model(weather)
-    total_dc_output = sum(mc.results.dc)
-
-    month_name = calendar.month_name[month]
-    results_raw[month_name] = total_dc_output.values
-
-    energy_kwh = total_dc_output.sum() * (pd.Timedelta(TIME_STEP).total_seconds() / 3600)
-    monthly_energy_kwh[month_name] = energy_kwh
-
-# === BATTERY SIMULATION ===
-results_battery = results_raw.copy()
-if SIMULATE_BATTERY:
-    for month in results_raw.columns:
-        soc = 0.0
-        adjusted_output = []
-        for power in results_raw[month]:
-            power_kw = power
-            energy = power_kw * (pd.Timedelta(TIME_STEP).total_seconds() / 3600)
-
-            if energy > 0:
-                excess_energy = max(0, energy - 0.5)
-                charge = min(excess_energy * BATTERY_CHARGE_EFFICIENCY, BATTERY_CAPACITY_KWH - soc)
-                soc += charge
-                net_energy = energy - charge
-            else:
-                net_energy = energy
-
-            if net_energy < 0.5:
-                needed = 0.5 - net_energy
-                discharge = min(needed / BATTERY_DISCHARGE_EFFICIENCY, soc)
-                soc -= discharge
-                net_energy += discharge * BATTERY_DISCHARGE_EFFICIENCY
-
-            adjusted_output.append(net_energy / (pd.Timedelta(TIME_STEP).total_seconds() / 3600))
-
-        results_battery[month] = adjusted_output
-else:
-    results_battery = None
-
-# === SMART GRID SIMULATION ===
-results_smart_grid = results_battery.copy() if results_battery is not None else results_raw.copy()
-if SIMULATE_SMART_GRID:
-    for month in results_smart_grid.columns:
-        adjusted_output = []
-        for power_kw in results_smart_grid[month]:
-            load_kw = 1.0
-            if power_kw < load_kw:
-                support = min(GRID_SUPPORT_LIMIT_KW, load_kw - power_kw)
-                adjusted_output.append(power_kw + support)
-            else:
-                adjusted_output.append(power_kw)
-        results_smart_grid[month] = adjusted_output
-else:
-    results_smart_grid = None
+monthly_totals = dc_by_month.sum(axis=1) * DT_H  # kWh per month
+monthly_energy_kwh = dict(zip(MONTH_NAMES, monthly_totals))
+
+# === BATTERY AND SMART GRID SIMULATION ===
+results_battery = None
+results_smart_grid = None
+if SIMULATE_BATTERY or SIMULATE_SMART_GRID:
+    battery_out, grid_out = battery_and_grid(
+        results_raw.to_numpy(dtype=np.float64), DT_H,
+        BATTERY_CAPACITY_KWH, BATTERY_CHARGE_EFFICIENCY, BATTERY_DISCHARGE_EFFICIENCY, 0.5,
+        GRID_SUPPORT_LIMIT_KW, 1.0,
+        SIMULATE_BATTERY, SIMULATE_SMART_GRID
+    )
+    if SIMULATE_BATTERY:
+        results_battery = pd.DataFrame(battery_out, index=time_of_day, columns=MONTH_NAMES)
+    if SIMULATE_SMART_GRID:
+        results_smart_grid = pd.DataFrame(grid_out, index=time_of_day, columns=MONTH_NAMES)
 
 # === PLOTTING ===
 markers = ['o', 's', 'D', '^', 'v', '<', '>', 'p', '*', 'h', 'H', 'X']
-colors = plt.cm.get_cmap('tab10', 12)
+colors = plt.colormaps['tab20'].resampled(12)(np.arange(12))  # 12 distinct RGBA colors
+month_style = cycler(color=list(colors)) + cycler(marker=markers)  # one style per month
 
 def plot_monthly_profiles(df, title_prefix):
     fig, ax = plt.subplots(figsize=(12, 8))
-    for month in range(1, 13):
-        month_name = calendar.month_name[month]
-        ax.plot(time_of_day, df[month_name],
-                marker=markers[month - 1], color=colors(month - 1), label=month_name, linestyle='-')
+    ax.set_prop_cycle(month_style)
+    ax.plot(time_of_day, df.to_numpy(), linestyle='-', label=list(df.columns))
     ax.set_xlabel('Time of Day')
     ax.set_ylabel('Total System Output (kW)')
     ax.set_title(f'{title_prefix} - Hourly Energy Production for One Day in Each Month')
@@ -169,11 +172,10 @@ def plot_monthly_profiles(df, title_prefix):
 
 def plot_normalized_profiles(df, title_prefix):
     fig, ax = plt.subplots(figsize=(12, 8))
-    for month in range(1, 13):
-        month_name = calendar.month_name[month]
-        normalized_output = df[month_name] / df[month_name].max()
-        ax.plot(time_of_day, normalized_output,
-                marker=markers[month - 1], color=colors(month - 1), label=month_name, linestyle='-')
+    output = df[MONTH_NAMES].to_numpy()
+    normalized_output = output / output.max(axis=0, keepdims=True)
+    ax.set_prop_cycle(month_style)
+    ax.plot(time_of_day, normalized_output, linestyle='-', label=MONTH_NAMES)
     ax.set_xlabel('Time of Day')
     ax.set_ylabel('Normalized System Output')
     ax.set_title(f'{title_prefix} - Normalized Hourly Energy Production for One Day in Each Month')
@@ -207,5 +209,5 @@ plt.grid(True)
 plt.tight_layout()
 plt.show()
 
-total_annual_energy = sum(monthly_energy_kwh.values())
+total_annual_energy = monthly_totals.sum()
 print(f"\n🔋 Total Annual Energy Production (Raw PV System Output): {total_annual_energy:.2f} kWh\n")
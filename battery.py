@@ -0,0 +1,44 @@
+# Battery + smart grid stage shared by app.py and app2.py. It lives in its own
+# module so Streamlit reruns reuse the compiled kernel from sys.modules.
+import numpy as np
+from numba import njit
+
+
+@njit(cache=True)
+def battery_and_grid(power, dt_h, cap, eff_c, eff_d, battery_load,
+                     grid_limit, grid_load, use_battery, use_grid):
+    # power is (time, month) in kW; the battery starts empty each month.
+    # battery_load is kWh per step, grid_load is kW. Returns the kW after the
+    # battery stage and after the grid stage, filled in the same sweep.
+    n_steps, n_months = power.shape
+    battery_out = np.empty((n_steps, n_months), dtype=np.float64)
+    grid_out = np.empty((n_steps, n_months), dtype=np.float64)
+    for j in range(n_months):
+        soc = 0.0
+        for i in range(n_steps):
+            power_kw = power[i, j]
+
+            if use_battery:
+                energy = power_kw * dt_h
+
+                if energy > 0:
+                    excess_energy = max(0.0, energy - battery_load)
+                    charge = min(excess_energy * eff_c, cap - soc)
+                    soc += charge
+                    net_energy = energy - charge
+                else:
+                    net_energy = energy
+
+                if net_energy < battery_load:
+                    needed = battery_load - net_energy
+                    discharge = min(needed / eff_d, soc)
+                    soc -= discharge
+                    net_energy += discharge * eff_d
+
+                power_kw = net_energy / dt_h
+            battery_out[i, j] = power_kw
+
+            if use_grid and power_kw < grid_load:
+                power_kw += min(grid_limit, grid_load - power_kw)
+            grid_out[i, j] = power_kw
+    return battery_out, grid_out